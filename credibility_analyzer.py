@@ -1,22 +1,99 @@
+import asyncio
+import hashlib
 import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import List, Dict
 import os
-import requests
+import random
+import diskcache
+import httpx
+import httplib2
+import google_auth_httplib2
+from aiolimiter import AsyncLimiter
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 import re
+from pft_collector import json_loads
+
+# ijson lets us stream the multi-MB memo dumps user-by-user; optional
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# tiktoken gives real token counts for sizing prompts; optional
+try:
+    import tiktoken
+    _ENCODER = tiktoken.get_encoding('cl100k_base')
+except ImportError:
+    _ENCODER = None
+
+def count_tokens(text: str) -> int:
+    """Count prompt tokens, falling back to a chars/4 estimate without tiktoken"""
+    if _ENCODER:
+        return len(_ENCODER.encode(text))
+    return len(text) // 4 + 1
+
+# Compiled once at import; these run against every memo / LLM response
+DOC_URL_PATTERN = re.compile(r'https://docs\.google\.com/document/[^\s\n]+')
+# Anchored on the word "score" so we don't pick up stray numbers in the explanation
+ANCHORED_SCORE_PATTERN = re.compile(
+    r'score\s*(?:is|of|:)?\s*\**\s*([0-9]{1,3})\b', re.IGNORECASE
+)
+SCORE_PATTERN = re.compile(r'\b([0-9]{1,3})\b')
+
+# Token budget per request, well inside the model's context window
+MAX_CONTEXT_TOKENS = 25_000
+
+# Shared instruction block. Kept byte-identical across users so Anthropic's
+# prompt caching can reuse its KV cache for the prefix on every call.
+RUBRIC = """Based on the following set of memos from a single user, assess their credibility
+regarding the given stock. Consider factors like:
+- Quality and depth of analysis
+- Consistency in their views
+- Professional knowledge demonstrated
+- Objectivity and lack of bias
+
+Please provide:
+1. A credibility score from 0-100
+2. A brief explanation of the score
+
+Recognize that what they are saying is very likely not directly related to the stock."""
 
 class CredibilityAnalyzer:
-    def __init__(self, api_key: str, google_creds_path: str):
+    def __init__(self, api_key: str, google_creds_path: str,
+                 max_concurrency: int = 8, requests_per_second: float = 4):
         self.openrouter_key = api_key
         self.api_url = "https://openrouter.ai/api/v1/chat/completions"
         self.headers = {
             "Authorization": f"Bearer {api_key}",
             "HTTP-Referer": "http://localhost:8000",
-            "Content-Type": "application/json"
+            "Content-Type": "application/json",
+            "anthropic-beta": "prompt-caching-2024-07-31"
         }
-        
+        # Limit how many analyses are in flight and how fast we hit the API
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.rate_limiter = AsyncLimiter(requests_per_second, 1)
+
+        # Persistent response cache so repeat runs don't re-pay for identical prompts
+        self.llm_cache = diskcache.Cache('.llm_cache')
+
+        # Finished per-user analyses keyed by memo-set hash, so users whose
+        # memos haven't changed since the last run are skipped entirely
+        self.analysis_cache = diskcache.Cache('.analysis_cache')
+
+        # Google Doc content keyed by doc_id, shared across memos and users
+        self._doc_cache = {}
+
+        # One executor for all doc prefetches; per-user pools would multiply
+        # threads under concurrent analyses
+        self._doc_executor = ThreadPoolExecutor(max_workers=16)
+
+        # Extracted doc text persisted across runs, keyed by (doc_id, revisionId)
+        # so edited docs are refetched but unchanged ones cost one cheap metadata call
+        self.gdocs_cache = diskcache.Cache('.gdocs_cache')
+
         # Setup Google Docs API
         try:
             self.credentials = service_account.Credentials.from_service_account_file(
@@ -38,38 +115,89 @@ class CredibilityAnalyzer:
 
     def _fetch_google_doc_content(self, url: str) -> str:
         """Fetch content from a Google Doc using the API"""
+        if not self.docs_service:
+            print("Google Docs API not initialized")
+            return ""
+
+        doc_id = self._extract_doc_id(url)
+        if not doc_id:
+            print(f"Could not extract document ID from URL: {url}")
+            return ""
+
+        if doc_id in self._doc_cache:
+            return self._doc_cache[doc_id]
+
         try:
-            if not self.docs_service:
-                print("Google Docs API not initialized")
-                return ""
-
-            doc_id = self._extract_doc_id(url)
-            if not doc_id:
-                print(f"Could not extract document ID from URL: {url}")
-                return ""
-            
-            document = self.docs_service.documents().get(documentId=doc_id).execute()
-            
-            # Extract text content
-            content = []
-            for element in document.get('body').get('content'):
-                if 'paragraph' in element:
-                    paragraph = element.get('paragraph')
-                    for elem in paragraph.get('elements'):
-                        if 'textRun' in elem:
-                            content.append(elem.get('textRun').get('content'))
-
-            full_content = ''.join(content)
-            
-            return full_content
-            
+            # A cheap metadata call tells us whether the persisted text is current
+            revision_id = self._get_doc_revision(doc_id)
+            cache_key = f"{doc_id}:{revision_id}"
+            full_content = self.gdocs_cache.get(cache_key)
+
+            if full_content is None:
+                full_content = self._fetch_full_doc(doc_id)
+                self.gdocs_cache.set(cache_key, full_content)
         except Exception as e:
             print(f"Error fetching Google Doc content from {url}: {e}")
+            # Record the failure so _process_memo_data doesn't refetch
+            # synchronously on the event loop later in the run
+            self._doc_cache[doc_id] = ""
             return ""
 
+        self._doc_cache[doc_id] = full_content
+        return full_content
+
+    def _authorized_http(self):
+        """Fresh authorized HTTP object per request
+
+        googleapiclient's service objects share one httplib2.Http, which is
+        not thread-safe; each call from the prefetch pool gets its own.
+        """
+        return google_auth_httplib2.AuthorizedHttp(self.credentials, http=httplib2.Http())
+
+    def _get_doc_revision(self, doc_id: str) -> str:
+        """Fetch just the document's revision id"""
+        document = self.docs_service.documents().get(
+            documentId=doc_id,
+            fields="revisionId"
+        ).execute(http=self._authorized_http())
+        return document.get('revisionId', '')
+
+    def _fetch_full_doc(self, doc_id: str) -> str:
+        """Fetch a document body and extract its plain text"""
+        # Only request the text runs we actually read, to shrink the payload
+        document = self.docs_service.documents().get(
+            documentId=doc_id,
+            fields="body(content(paragraph(elements(textRun(content)))))"
+        ).execute(http=self._authorized_http())
+
+        # Generator feeds join directly; no intermediate list of text runs
+        return ''.join(
+            elem['textRun'].get('content', '')
+            for element in document.get('body').get('content')
+            if 'paragraph' in element
+            for elem in element['paragraph'].get('elements')
+            if 'textRun' in elem
+        )
+
+    async def _prefetch_doc_contents(self, memos: List[Dict]):
+        """Fetch all Google Docs referenced by a set of memos in parallel"""
+        urls = set()
+        for memo in memos:
+            urls.update(DOC_URL_PATTERN.findall(memo['memo_data']))
+
+        if not urls:
+            return
+
+        # Results land in self._doc_cache; _process_memo_data reads from there
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[
+            loop.run_in_executor(self._doc_executor, self._fetch_google_doc_content, url)
+            for url in urls
+        ])
+
     def _process_memo_data(self, memo_data: str) -> str:
         """Process memo data, including fetching Google Doc content if needed"""
-        urls = re.findall(r'https://docs\.google\.com/document/[^\s\n]+', memo_data)
+        urls = DOC_URL_PATTERN.findall(memo_data)
         
         if urls:
             processed_content = memo_data
@@ -80,69 +208,251 @@ class CredibilityAnalyzer:
             return processed_content
         return memo_data
 
-    def analyze_user_memos(self, memos: List[Dict], stock_symbol: str) -> Dict:
+    @staticmethod
+    def _memo_set_hash(memos: List[Dict]) -> str:
+        """Hash a user's memo texts, ignoring memo order"""
+        return hashlib.sha256(
+            '\x00'.join(sorted(memo['memo_data'] for memo in memos)).encode()
+        ).hexdigest()
+
+    @staticmethod
+    def _memo_date_range(memos: List[Dict]) -> tuple:
+        """Find the first and last memo timestamps in one pass"""
+        first_ts = last_ts = memos[0]['timestamp']
+        for memo in memos[1:]:
+            ts = memo['timestamp']
+            if ts < first_ts:
+                first_ts = ts
+            elif ts > last_ts:
+                last_ts = ts
+        return first_ts, last_ts
+
+    async def analyze_user_memos(self, client: httpx.AsyncClient, memos: List[Dict], stock_symbol: str) -> Dict:
         """Analyze a user's memos to determine their credibility regarding a specific stock"""
-        
+
+        # Skip users whose memo set is unchanged since a previous run. The
+        # stored entry carries another user's (or run's) count and timestamps,
+        # so rebuild the per-user fields from the memos at hand
+        analysis_key = f"{stock_symbol}:{self._memo_set_hash(memos)}"
+        cached_analysis = self.analysis_cache.get(analysis_key)
+        if cached_analysis is not None:
+            print(f"\nMemo set unchanged, reusing previous analysis of {len(memos)} memos")
+            first_ts, last_ts = self._memo_date_range(memos)
+            return {
+                **cached_analysis,
+                'memo_count': len(memos),
+                'date_range': {'first': first_ts, 'last': last_ts}
+            }
+
         print(f"\nAnalyzing {len(memos)} memos...")
+        # Warm the doc cache for every linked doc up-front, off the event loop
+        await self._prefetch_doc_contents(memos)
+
+        # Drop exact-duplicate memos (reposted tasks, retries) so we don't pay
+        # to send the same text twice; order of first occurrence is kept
+        seen = set()
         processed_memos = []
         for memo in memos:
-            processed_memo = self._process_memo_data(memo['memo_data'])
-            processed_memos.append(processed_memo)
-        
-        combined_context = "\n---\n".join(processed_memos)
-        
-        prompt = f"""Based on the following set of memos from a single user, assess their credibility 
-        regarding {stock_symbol}. Consider factors like:
-        - Quality and depth of analysis
-        - Consistency in their views
-        - Professional knowledge demonstrated
-        - Objectivity and lack of bias
-        
-        Please provide:
-        1. A credibility score from 0-100
-        2. A brief explanation of the score
+            if memo['memo_data'] in seen:
+                continue
+            seen.add(memo['memo_data'])
+            processed_memos.append(self._process_memo_data(memo['memo_data']))
 
-        Recognize that what they are saying is very likely not directly related to the stock.
-        
-        User's memos:
-        {combined_context}"""
+        # Single pass over the timestamps instead of separate min() and max() scans
+        first_ts, last_ts = self._memo_date_range(memos)
+
+        # Map: analyze the context chunks concurrently (the shared semaphore
+        # and rate limiter still bound the actual API calls) so oversized
+        # users don't pay chunk-count round trips back to back; reduce:
+        # average the per-chunk scores. gather preserves part ordering
+        results = await asyncio.gather(*(
+            self._request_analysis(client, chunk, stock_symbol)
+            for chunk in self._chunk_memo_contexts(processed_memos)
+        ))
+        contents = [content for content in results if content is not None]
+
+        if not contents:
+            return None
+
+        scores = [self._extract_score(content) for content in contents]
+        if len(contents) == 1:
+            explanation = contents[0]
+        else:
+            explanation = "\n\n".join(
+                f"--- Part {i + 1} of {len(contents)} ---\n{content}"
+                for i, content in enumerate(contents)
+            )
+
+        analysis = {
+            'score': round(sum(scores) / len(scores)),
+            'explanation': explanation,
+            'memo_count': len(memos),
+            'date_range': {
+                'first': first_ts,
+                'last': last_ts
+            }
+        }
+        self.analysis_cache.set(analysis_key, analysis, expire=7 * 86400)
+        return analysis
+
+    def _chunk_memo_contexts(self, processed_memos: List[str]) -> List[str]:
+        """Pack processed memos into contexts no larger than MAX_CONTEXT_TOKENS"""
+        separator = "\n---\n"
+        separator_tokens = count_tokens(separator)
+        chunks = []
+        current = []
+        current_tokens = 0
+
+        for memo_text in processed_memos:
+            # A single memo beyond the budget (usually a huge linked doc) is
+            # hard-split into roughly equal character slices
+            memo_tokens = count_tokens(memo_text)
+            if memo_tokens > MAX_CONTEXT_TOKENS:
+                n_pieces = -(-memo_tokens // MAX_CONTEXT_TOKENS)
+                piece_len = -(-len(memo_text) // n_pieces)
+                pieces = [
+                    memo_text[i:i + piece_len]
+                    for i in range(0, len(memo_text), piece_len)
+                ]
+            else:
+                pieces = [memo_text]
 
+            for piece in pieces:
+                piece_tokens = count_tokens(piece) if len(pieces) > 1 else memo_tokens
+                if current and current_tokens + piece_tokens > MAX_CONTEXT_TOKENS:
+                    chunks.append(separator.join(current))
+                    current = []
+                    current_tokens = 0
+                current.append(piece)
+                current_tokens += piece_tokens + separator_tokens
+
+        if current:
+            chunks.append(separator.join(current))
+        return chunks or ['']
+
+    async def _request_analysis(self, client: httpx.AsyncClient, combined_context: str, stock_symbol: str) -> str:
+        """Run one credibility prompt against the API, returning the response text"""
         try:
             payload = {
                 "model": "anthropic/claude-3.5-haiku-20241022",
                 "messages": [
-                    {"role": "user", "content": prompt}
-                ]
-            }
-            
-            response = requests.post(
-                self.api_url,
-                headers=self.headers,
-                json=payload
-            )
-            response.raise_for_status()
-            
-            result = response.json()
-            content = result['choices'][0]['message']['content']
-            
-            return {
-                'score': self._extract_score(content),
-                'explanation': content,
-                'memo_count': len(memos),
-                'date_range': {
-                    'first': min(memo['timestamp'] for memo in memos),
-                    'last': max(memo['timestamp'] for memo in memos)
-                }
+                    {
+                        "role": "user",
+                        "content": [
+                            # Static rubric first, marked cacheable, then the per-user suffix
+                            {
+                                "type": "text",
+                                "text": RUBRIC,
+                                "cache_control": {"type": "ephemeral"}
+                            },
+                            {
+                                "type": "text",
+                                "text": f"Stock: {stock_symbol}\nUser's memos:\n{combined_context}"
+                            }
+                        ]
+                    }
+                ],
+                # Deterministic responses so identical prompts are cacheable
+                "temperature": 0
             }
+
+            # Check the persistent cache before paying for an API call
+            cache_key = hashlib.sha256(
+                json.dumps(payload, sort_keys=True).encode()
+            ).hexdigest()
+            result = self.llm_cache.get(cache_key)
+
+            if result is None:
+                response = await self._post_with_retry(client, payload)
+                result = response.json()
+                self.llm_cache.set(cache_key, result, expire=7 * 86400)
+
+            return result['choices'][0]['message']['content']
         except Exception as e:
             print(f"Error analyzing memos: {e}")
             return None
 
+    async def _post_with_retry(self, client: httpx.AsyncClient, payload: Dict, max_attempts: int = 4) -> httpx.Response:
+        """POST to OpenRouter, retrying rate limits and server errors with backoff"""
+        for attempt in range(max_attempts):
+            async with self.semaphore:
+                async with self.rate_limiter:
+                    response = await client.post(
+                        self.api_url,
+                        headers=self.headers,
+                        json=payload
+                    )
+
+            retryable = response.status_code == 429 or response.status_code >= 500
+            if not retryable or attempt == max_attempts - 1:
+                response.raise_for_status()
+                return response
+
+            # Honour the server's Retry-After if given (capped so a bad value
+            # can't stall a task), otherwise back off exponentially with
+            # jitter so retries don't arrive in lockstep
+            retry_after = response.headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                wait = min(int(retry_after), 30)
+            else:
+                wait = 2 ** attempt + random.uniform(0, 1)
+            print(f"OpenRouter returned {response.status_code}, retrying in {wait:.1f}s...")
+            await asyncio.sleep(wait)
+
+    async def analyze_all_users(self, user_memos: Dict[str, List[Dict]], stock_symbol: str) -> Dict[str, Dict]:
+        """Analyze all users' memos concurrently, returning results keyed by user address"""
+        # Users with identical memo sets would otherwise all miss the response
+        # cache at once and each pay for a call; group them up-front and only
+        # dispatch one representative per group
+        groups = {}
+        for user, memos in user_memos.items():
+            groups.setdefault(self._memo_set_hash(memos), []).append(user)
+
+        async with httpx.AsyncClient(timeout=60) as client:
+            # Keep calls close together in time (largest contexts first) so the
+            # cached rubric prefix stays within its 5-minute TTL
+            representatives = sorted(
+                (users[0] for users in groups.values()),
+                key=lambda user: sum(len(memo['memo_data']) for memo in user_memos[user]),
+                reverse=True
+            )
+            tasks = [
+                self.analyze_user_memos(client, user_memos[user], stock_symbol)
+                for user in representatives
+            ]
+            results = await asyncio.gather(*tasks)
+
+        rep_analyses = dict(zip(representatives, results))
+
+        # Fan each group's result out to its members, rebuilding the fields
+        # that are user-specific (count and timestamps can differ even when
+        # the memo texts are identical)
+        analyses = {}
+        for users in groups.values():
+            analysis = rep_analyses[users[0]]
+            if not analysis:
+                continue
+            analyses[users[0]] = analysis
+            for user in users[1:]:
+                memos = user_memos[user]
+                first_ts, last_ts = self._memo_date_range(memos)
+                analyses[user] = {
+                    **analysis,
+                    'memo_count': len(memos),
+                    'date_range': {'first': first_ts, 'last': last_ts}
+                }
+        return analyses
+
     def _extract_score(self, response_text: str) -> int:
         """Extract the numerical score from the LLM response"""
         try:
-            numbers = re.findall(r'\b([0-9]{1,3})\b', response_text)
-            for num in numbers:
+            # Prefer a number explicitly attached to "score"; fall back to the
+            # first in-range number anywhere in the response
+            match = ANCHORED_SCORE_PATTERN.search(response_text)
+            if match and 0 <= int(match.group(1)) <= 100:
+                return int(match.group(1))
+
+            for num in SCORE_PATTERN.findall(response_text):
                 num = int(num)
                 if 0 <= num <= 100:
                     return num
@@ -150,6 +460,32 @@ class CredibilityAnalyzer:
         except:
             return 0
 
+async def analyze_memo_file(analyzer: CredibilityAnalyzer, path: str, stock_symbol: str,
+                            batch_size: int = 64) -> Dict[str, Dict]:
+    """Stream users from a memo dump and analyze them in batches
+
+    With ijson installed, the file is parsed incrementally one user at a time
+    so the whole multi-MB dump never sits in memory at once; otherwise the
+    file is loaded in full as before.
+    """
+    analyses = {}
+    batch = {}
+    with open(path, 'rb') as f:
+        if ijson:
+            users = ijson.kvitems(f, '')
+        else:
+            users = iter(json_loads(f.read()).items())
+
+        for user_address, memos in users:
+            batch[user_address] = memos
+            if len(batch) >= batch_size:
+                analyses.update(await analyzer.analyze_all_users(batch, stock_symbol))
+                batch = {}
+
+    if batch:
+        analyses.update(await analyzer.analyze_all_users(batch, stock_symbol))
+    return analyses
+
 def main():
     # Load credentials from config.json
     try:
@@ -168,18 +504,22 @@ def main():
     
     analyzer = CredibilityAnalyzer(openrouter_key, google_creds_path)
 
-    # Find the most recent pft_user_memos file
-    memo_files = [f for f in os.listdir('.') if f.startswith('pft_user_memos_') and f.endswith('.json')]
-    if not memo_files:
+    # Find the most recent pft_user_memos file in one directory scan,
+    # keyed explicitly on the timestamp embedded in the filename
+    latest_memo_file = None
+    with os.scandir('.') as entries:
+        for entry in entries:
+            name = entry.name
+            if (entry.is_file() and name.startswith('pft_user_memos_')
+                    and name.endswith('.json')):
+                if latest_memo_file is None or name > latest_memo_file:
+                    latest_memo_file = name
+
+    if latest_memo_file is None:
         print("No PFT memo files found!")
         return
-        
-    latest_memo_file = max(memo_files)  # Gets the most recent file based on timestamp in filename
-    print(f"Using memo file: {latest_memo_file}")
 
-    # Load the memo data
-    with open(latest_memo_file, 'r') as f:
-        user_memos = json.load(f)
+    print(f"Using memo file: {latest_memo_file}")
 
     stock_symbol = "NVDA"  # Change this to your target stock
 
@@ -196,24 +536,22 @@ def main():
     }
 
     total_score = 0
-    
-    # Process the data
-    for user_address, memos in user_memos.items():
-        print(f"Analyzing user {user_address}...")
-        analysis = analyzer.analyze_user_memos(memos, stock_symbol)
-        if analysis:
-            output["user_analyses"][user_address] = {
-                "credibility_score": analysis['score'],
-                "explanation": analysis['explanation'],
-                "analysis_details": {
-                    "memo_count": analysis['memo_count'],
-                    "first_memo_date": analysis['date_range']['first'],
-                    "last_memo_date": analysis['date_range']['last'],
-                    "memo_timespan_days": (datetime.fromisoformat(analysis['date_range']['last']) - 
-                                         datetime.fromisoformat(analysis['date_range']['first'])).days
-                }
+
+    # Process the data, streaming users from disk in batches
+    analyses = asyncio.run(analyze_memo_file(analyzer, latest_memo_file, stock_symbol))
+    for user_address, analysis in analyses.items():
+        output["user_analyses"][user_address] = {
+            "credibility_score": analysis['score'],
+            "explanation": analysis['explanation'],
+            "analysis_details": {
+                "memo_count": analysis['memo_count'],
+                "first_memo_date": analysis['date_range']['first'],
+                "last_memo_date": analysis['date_range']['last'],
+                "memo_timespan_days": (datetime.fromisoformat(analysis['date_range']['last']) -
+                                     datetime.fromisoformat(analysis['date_range']['first'])).days
             }
-            total_score += analysis['score']
+        }
+        total_score += analysis['score']
 
     # Update metadata
     output["analysis_metadata"]["total_users_analyzed"] = len(output["user_analyses"])
@@ -1,150 +1,252 @@
-from xrpl.clients import JsonRpcClient
-from xrpl.models import AccountTx, LedgerCurrent
+from xrpl.asyncio.clients import AsyncJsonRpcClient
+from xrpl.core import binarycodec
+from xrpl.models import AccountTx, Ledger, LedgerCurrent
+import asyncio
+import hashlib
 import json
-import binascii
 from datetime import datetime
-import time
 from collections import defaultdict
 import os
 
+# Seconds between the Unix and Ripple epochs (2000-01-01)
+RIPPLE_EPOCH_OFFSET = 946684800
+
+# TransactionType is always the first field of a serialized transaction
+# (UInt16, field code 0x12); Payment has type code 0
+PAYMENT_TYPE_PREFIX = '120000'
+
+# orjson is much faster on the multi-MB memo dumps; fall back to stdlib json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def json_loads(data):
+    """Parse JSON with orjson when available"""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps_line(obj):
+    """Serialize one object to a compact JSON string"""
+    if orjson:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
+
 class PFTMemoCollector:
     def __init__(self, node_url="https://xrplcluster.com", start_ledger=83999999):
-        self.client = JsonRpcClient(node_url)
+        self.client = AsyncJsonRpcClient(node_url)
         self.start_ledger = start_ledger
+        # Ledger close times, fetched once per ledger that holds a matching tx
+        self._close_times = {}
         
     def decode_memo(self, memo_hex):
         """Decode hex-encoded memo data to UTF-8 string"""
         try:
-            memo_hex = memo_hex.replace('0x', '')
-            return binascii.unhexlify(memo_hex).decode('utf-8')
+            # Only strip a real 0x prefix; avoids a copy on the common path
+            if memo_hex.startswith('0x'):
+                memo_hex = memo_hex[2:]
+            return bytes.fromhex(memo_hex).decode('utf-8')
         except Exception as e:
             print(f"Failed to decode memo: {e}")
             return None
 
-    def collect_user_memos(self, currency, issuer, start_ledger=None, end_ledger=None, batch_size=1000000):
-        """Collect all memos grouped by user"""
-        user_memos = defaultdict(list)
-        marker = None
-        processed_txs = 0
-        
+    async def collect_user_memos(self, currency, issuer, start_ledger=None, end_ledger=None,
+                                 batch_size=1000000, output_path=None, max_concurrency=4):
+        """Collect all memos grouped by user
+
+        The ledger range is pre-split into batch_size chunks and each chunk's
+        marker chain is scanned as its own task, with max_concurrency scans in
+        flight at once, so page fetches for different ranges overlap.
+
+        If output_path is given, each memo is appended to that file as a JSON
+        line the moment it is decoded instead of being accumulated in memory,
+        and None is returned; use load_user_memos to group the file afterwards.
+        """
         # Use instance start_ledger if none provided
         if start_ledger is None:
             start_ledger = self.start_ledger
-            
+
         # Get current ledger if end_ledger not provided
         if end_ledger is None:
-            end_ledger = self.client.request(LedgerCurrent()).result["ledger_current_index"]
-        
-        current_start = start_ledger  # Use the provided or instance start_ledger
-        
-        print(f"Starting collection from ledger {current_start} to {end_ledger}")
-        
-        while current_start < end_ledger:
-            try:
-                # Calculate batch end ledger
-                batch_end = min(current_start + batch_size, end_ledger)
-                
-                print(f"\nProcessing ledger range: {current_start} to {batch_end}")
-                
-                # Prepare request - include marker in initial creation if it exists
-                request_params = {
-                    "account": issuer,
-                    "ledger_index_min": current_start,
-                    "ledger_index_max": batch_end,
-                    "forward": True,
-                    "limit": 400
-                }
-                if marker:
-                    request_params["marker"] = marker
-                    
-                request = AccountTx(**request_params)
-                
-                # Make request
-                response = self.client.request(request)
-                result = response.result
-                
-                # Debug logging
-                print(f"API Response keys: {result.keys()}")
-                
-                # Check if response contains transactions
-                if 'transactions' not in result:
-                    print(f"Warning: No transactions found in response. Response: {result}")
-                    # Move to next batch
-                    current_start = batch_end
-                    marker = None
-                    if current_start >= end_ledger and end_ledger != -1:
-                        break
-                    continue
+            end_ledger = (await self.client.request(LedgerCurrent())).result["ledger_current_index"]
 
-                # Update marker for pagination
-                marker = result.get('marker')
-                
-                # Process transactions
-                for tx_info in result['transactions']:
-                    tx = tx_info['tx']
-                    processed_txs += 1
-                    
-                    # Skip if not a Payment
-                    if tx['TransactionType'] != 'Payment':
-                        continue
-                        
-                    # Check if it's a PFT payment
-                    if isinstance(tx.get('Amount'), dict):
-                        if tx['Amount'].get('currency') != currency:
-                            continue
-                    else:  # XRP payment
-                        continue
-                    
-                    # Process memos if present
-                    if 'Memos' in tx:
-                        for memo_obj in tx['Memos']:
-                            memo = memo_obj.get('Memo', {})
-                            memo_data = self.decode_memo(memo.get('MemoData', ''))
-                            
-                            if memo_data:
-                                memo_info = {
-                                    'tx_hash': tx.get('hash'),
-                                    'ledger_index': tx.get('ledger_index'),
-                                    'timestamp': datetime.fromtimestamp(
-                                        tx.get('date', 0) + 946684800
-                                    ).isoformat(),
-                                    'memo_data': memo_data,
-                                    'sender': tx.get('Account'),
-                                    'destination': tx.get('Destination'),
-                                    'amount': tx.get('Amount')
-                                }
-                                user_memos[tx.get('Account')].append(memo_info)
-                
-                print(f"Processed {processed_txs} transactions")
-                print(f"Users found with memos: {len(user_memos)}")
-                
-                # If no more transactions in this batch, move to next batch
-                if not marker:
-                    current_start = batch_end
-                    if current_start >= end_ledger and end_ledger != -1:
-                        break
-                    marker = None
-                
-                # Rate limiting
-                time.sleep(0.1)
-                
-            except Exception as e:
-                print(f"Error processing transactions: {e}")
-                # Save results on error
-                self.save_results(user_memos, f"pft_user_memos_error_{current_start}.json")
-                raise
-        
+        user_memos = defaultdict(list)
+        users_seen = set()
+        # 'w' so re-runs against the same path don't append a second full copy
+        out_file = open(output_path, 'w') if output_path else None
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        ranges = [
+            (range_start, min(range_start + batch_size, end_ledger))
+            for range_start in range(start_ledger, end_ledger, batch_size)
+        ]
+        print(f"Starting collection from ledger {start_ledger} to {end_ledger} "
+              f"in {len(ranges)} ranges")
+
+        try:
+            await asyncio.gather(*[
+                self._collect_range(currency, issuer, range_start, range_end,
+                                    semaphore, user_memos, users_seen, out_file)
+                for range_start, range_end in ranges
+            ])
+        except Exception as e:
+            print(f"Error processing transactions: {e}")
+            # Save results on error; when streaming, everything decoded so far
+            # is already on disk
+            if out_file:
+                out_file.close()
+            else:
+                self.save_results(user_memos, f"pft_user_memos_error_{start_ledger}.json")
+            raise
+
+        if out_file:
+            out_file.close()
+            return None
         return user_memos
 
+    async def _collect_range(self, currency, issuer, range_start, range_end,
+                             semaphore, user_memos, users_seen, out_file):
+        """Walk one ledger range's marker chain, recording decoded memos"""
+        marker = None
+        processed_txs = 0
+
+        print(f"\nProcessing ledger range: {range_start} to {range_end}")
+
+        while True:
+            # Prepare request - include marker in initial creation if it exists.
+            # Binary mode keeps each tx as a compact blob and leaves the bulky
+            # metadata undecoded; we only parse the few blobs that matter
+            request_params = {
+                "account": issuer,
+                "ledger_index_min": range_start,
+                "ledger_index_max": range_end,
+                "forward": True,
+                "binary": True,
+                "limit": 400
+            }
+            if marker:
+                request_params["marker"] = marker
+
+            request = AccountTx(**request_params)
+
+            # Make request; the semaphore caps how many scans hit the node at once
+            async with semaphore:
+                response = await self.client.request(request)
+            result = response.result
+
+            # Check if response contains transactions
+            if 'transactions' not in result:
+                print(f"Warning: No transactions found in response. Response: {result}")
+                break
+
+            # Update marker for pagination
+            marker = result.get('marker')
+
+            # Process transactions
+            for tx_info in result['transactions']:
+                processed_txs += 1
+                tx_blob = tx_info.get('tx_blob')
+
+                # A prefix check on the blob rejects non-Payments without
+                # decoding anything
+                if not tx_blob or not tx_blob.startswith(PAYMENT_TYPE_PREFIX):
+                    continue
+
+                try:
+                    tx = binarycodec.decode(tx_blob)
+                except Exception as e:
+                    print(f"Failed to decode transaction blob: {e}")
+                    continue
+
+                # Most Payments carry no memos at all; reject those next
+                if 'Memos' not in tx:
+                    continue
+
+                # Check if it's a PFT payment (XRP payments have a string Amount)
+                amount = tx.get('Amount')
+                if not isinstance(amount, dict) or amount.get('currency') != currency:
+                    continue
+
+                # Binary entries omit the server-computed close time and hash;
+                # look up the ledger's close time (cached per ledger) and hash
+                # the blob ourselves
+                ledger_index = tx_info.get('ledger_index')
+                close_time = await self._get_ledger_close_time(ledger_index, semaphore)
+                tx_hash = hashlib.sha512(
+                    b'TXN\x00' + bytes.fromhex(tx_blob)
+                ).digest()[:32].hex().upper()
+
+                for memo_obj in tx['Memos']:
+                    memo = memo_obj.get('Memo', {})
+                    memo_data = self.decode_memo(memo.get('MemoData', ''))
+
+                    if memo_data:
+                        memo_info = {
+                            'tx_hash': tx_hash,
+                            'ledger_index': ledger_index,
+                            'timestamp': datetime.fromtimestamp(
+                                close_time + RIPPLE_EPOCH_OFFSET
+                            ).isoformat(),
+                            'memo_data': memo_data,
+                            'sender': tx.get('Account'),
+                            'destination': tx.get('Destination'),
+                            'amount': amount
+                        }
+                        users_seen.add(tx.get('Account'))
+                        if out_file:
+                            out_file.write(json_dumps_line(memo_info) + '\n')
+                        else:
+                            user_memos[tx.get('Account')].append(memo_info)
+
+            if out_file:
+                # Keep the file current so a crash loses at most one page
+                out_file.flush()
+
+            print(f"Ledger range {range_start}-{range_end}: "
+                  f"processed {processed_txs} transactions, "
+                  f"{len(users_seen)} users with memos so far")
+
+            if not marker:
+                break
+
+            # Rate limiting
+            await asyncio.sleep(0.1)
+
+    async def _get_ledger_close_time(self, ledger_index, semaphore):
+        """Fetch a ledger's close time (Ripple epoch), caching per ledger
+
+        The cache is checked before acquiring the semaphore so hits stay
+        cheap; misses count against the same concurrency cap as the scans.
+        """
+        if ledger_index not in self._close_times:
+            async with semaphore:
+                response = await self.client.request(Ledger(ledger_index=ledger_index))
+            self._close_times[ledger_index] = response.result['ledger']['close_time']
+        return self._close_times[ledger_index]
+
     def save_results(self, user_memos, filename):
         """Save results to a JSON file"""
         with open(filename, 'w') as f:
             json.dump(user_memos, f, indent=2)
 
-    def get_earliest_ledger(self):
+    @staticmethod
+    def load_user_memos(path):
+        """Group a streamed JSON-lines memo file by sender"""
+        user_memos = defaultdict(list)
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                memo_info = json_loads(line)
+                user_memos[memo_info['sender']].append(memo_info)
+        return dict(user_memos)
+
+    async def get_earliest_ledger(self):
         """Get the earliest available ledger index"""
         try:
-            response = self.client.request(AccountTx(
+            response = await self.client.request(AccountTx(
                 account=self.issuer,
                 ledger_index_min=-1,
                 ledger_index_max=-1,
@@ -157,41 +259,39 @@ class PFTMemoCollector:
             print(f"Error getting earliest ledger: {e}")
         return 1
 
-    def validate_ledger_range(self, start_ledger, end_ledger):
+    async def validate_ledger_range(self, start_ledger, end_ledger):
         """Validate and adjust ledger range if needed"""
-        current_ledger = self.client.request(LedgerCurrent()).result["ledger_current_index"]
-        earliest_ledger = self.get_earliest_ledger()
+        current_ledger = (await self.client.request(LedgerCurrent())).result["ledger_current_index"]
+        earliest_ledger = await self.get_earliest_ledger()
         
         start_ledger = max(earliest_ledger, start_ledger)
         end_ledger = min(current_ledger, end_ledger)
         
         return start_ledger, end_ledger
 
-def main():
+async def main():
     # Initialize collector
     collector = PFTMemoCollector()
-    
+
     # PFT token configuration
     CURRENCY = "PFT"
     ISSUER = "rnQUEEg8yyjrwk9FhyXpKavHyCRJM9BDMW"
-    
+
     # Start from when PFT was created (around ledger 83999999)
     PFT_CREATION_LEDGER = 83999999
-    current_ledger = collector.client.request(LedgerCurrent()).result["ledger_current_index"]
-    
+    current_ledger = (await collector.client.request(LedgerCurrent())).result["ledger_current_index"]
+
     print(f"Starting to collect memos for {CURRENCY} token...")
     print(f"Collecting from ledger {PFT_CREATION_LEDGER} to {current_ledger}")
-    
-    # Collect memos
-    user_memos = collector.collect_user_memos(
+
+    # Collect memos, streaming them straight to disk
+    await collector.collect_user_memos(
         currency=CURRENCY,
         issuer=ISSUER,
         start_ledger=PFT_CREATION_LEDGER,
-        end_ledger=current_ledger
+        end_ledger=current_ledger,
+        output_path="pft_user_memos.jsonl"
     )
-    
-    # Save results
-    collector.save_results(user_memos, "pft_user_memos.json")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import os
 from datetime import datetime
@@ -12,7 +13,7 @@ def load_config():
         print("Error: config.json not found. Please create it with your API keys.")
         return None
 
-def main():
+async def main():
     # Load configuration
     config = load_config()
     if not config:
@@ -26,18 +27,19 @@ def main():
     CURRENCY = "PFT"
     ISSUER = "rnQUEEg8yyjrwk9FhyXpKavHyCRJM9BDMW"
     
-    # Collect memos
-    user_memos = collector.collect_user_memos(
+    # Collect memos, streaming them straight to disk
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    memo_file = f"pft_memos_{timestamp}.jsonl"
+    await collector.collect_user_memos(
         currency=CURRENCY,
         issuer=ISSUER,
-        batch_size=1000000
+        batch_size=1000000,
+        output_path=memo_file
     )
-    
-    # Save collected memos
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    memo_file = f"pft_memos_{timestamp}.json"
-    collector.save_results(user_memos, memo_file)
-    
+
+    # Group the streamed memos by user for analysis
+    user_memos = PFTMemoCollector.load_user_memos(memo_file)
+
     # Step 2: Analyze credibility
     print("\n=== Analyzing Credibility ===")
     analyzer = CredibilityAnalyzer(
@@ -45,14 +47,10 @@ def main():
         config['google_creds_path']
     )
     
-    # Analyze each user's memos
-    analysis_results = {}
-    for user_address, memos in user_memos.items():
-        print(f"\nAnalyzing user {user_address}...")
-        analysis = analyzer.analyze_user_memos(memos, "PFT")
-        if analysis:
-            analysis_results[user_address] = analysis
-    
+    # Analyze all users' memos concurrently
+    print(f"\nAnalyzing {len(user_memos)} users...")
+    analysis_results = await analyzer.analyze_all_users(user_memos, "PFT")
+
     # Save analysis results
     analysis_file = f"credibility_analysis_{timestamp}.json"
     with open(analysis_file, 'w') as f:
@@ -63,4 +61,4 @@ def main():
     print(f"Analysis results saved to: {analysis_file}")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())